@@ -10,12 +10,18 @@ Telegram Delivery Bot - Live Location (Drivers) + Orders + Google Sheets
 """
 
 import os
+import secrets
 import sys
+import asyncio
 import logging
 import time
 import math
-from datetime import datetime, timedelta
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+import numpy as np
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -45,12 +51,15 @@ from telegram import (
 )
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
     CallbackQueryHandler,
     ConversationHandler,
+    PersistenceInput,
+    PicklePersistence,
 )
 
 # Add this right after imports
@@ -76,13 +85,60 @@ LOG_FILE_PATH = "bot_debug.log"
 # Live location / inactivity
 INACTIVE_THRESHOLD = 10  # minutes after last_update driver is considered inactive
 MAX_DISPLAY_DRIVERS = 10
+SEARCH_RADIUS_KM = 25  # drivers farther than this from the client are not offered
 CURRENCY = "SAR"
 
+# In-memory cache of the sheets
+CACHE_REFRESH_INTERVAL = 300  # seconds between full reloads from Google Sheets
+SHEET_FLUSH_DELAY = 2.0  # seconds queued writes may wait to be batched together
+SHEET_RETRY_MAX_DELAY = 60  # longest backoff between retries of a failed flush
+SHEET_GROW_ROWS = 500  # spare rows added when new rows reach the end of a worksheet's grid
+LOCATION_WRITE_INTERVAL = 60  # seconds between sheet writes of live driver locations
+SHEETS_MAX_WORKERS = 4  # concurrent Google Sheets API calls
+
+# Telegram client
+CONCURRENT_UPDATES = 32     # updates handled in parallel; updates within one chat stay in order
+CONNECTION_POOL_SIZE = 100  # httpx connections for outgoing Bot API calls
+# Bot API timeouts (seconds): fail fast rather than pile up waiting handlers
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 10.0
+WRITE_TIMEOUT = 10.0
+POOL_TIMEOUT = 5.0          # wait for a free pooled connection
+POLL_TIMEOUT = 30           # seconds each getUpdates long poll may wait for new updates
+# only the update types the handlers use; Telegram skips the rest server-side
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY]
+
+# Webhook mode: set WEBHOOK_URL (public https base URL) to receive updates by webhook instead of polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# unguessable by default; run_webhook re-registers the URL with Telegram on every start
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH") or secrets.token_urlsafe(24)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # required; checked against Telegram's secret header
+PORT = int(os.environ.get("PORT", 10000))
+
+# Pending driver replies are kept in a PicklePersistence file; they only survive
+# restarts if PERSISTENCE_PATH points at persistent storage (e.g. a mounted disk),
+# the default local path is lost on hosts with an ephemeral filesystem like Render
+PERSISTENCE_PATH = os.environ.get("PERSISTENCE_PATH", "bot_state.pickle")
+PERSISTENCE_FLUSH_INTERVAL = 30  # seconds between writes of the persistence file
+PENDING_TTL = 600  # seconds an unanswered request / counter offer stays pending
+
 # Sheets names
 ORDERS_SHEET_NAME = "Orders"
 DRIVERS_SHEET_NAME = "Drivers"
 USERS_SHEET_NAME = "Users"
 
+ORDERS_HEADER = [
+    "order_id", "client_id", "client_name", "pickup_loc", "pickup_desc",
+    "dest_loc", "dest_desc", "client_price", "currency", "status",
+    "driver_id", "driver_name", "driver_price", "counter_price", "timestamp"
+]
+DRIVERS_HEADER = [
+    "driver_id", "driver_name", "chat_id", "age", "nationality", "phone",
+    "vehicle_type", "vehicle_make", "vehicle_year", "gender",
+    "latitude", "longitude", "last_update", "active"
+]
+USERS_HEADER = ["user_id", "name", "role", "timestamp"]
+
 # --------------------------- Logging Setup ---------------------------
 logger = logging.getLogger("telegram_delivery_bot_live")
 logger.setLevel(logging.DEBUG if DEBUG_MODE else logging.WARNING)
@@ -124,46 +180,336 @@ def connect_sheets(GOOGLE_CREDS_JSON: str, sheet_id: str):
     gc = gspread.authorize(creds)
     return gc.open_by_key(sheet_id)
 
+# gspread is blocking: run it off the event loop, a few calls at a time
+SHEETS_EXECUTOR = ThreadPoolExecutor(SHEETS_MAX_WORKERS, thread_name_prefix="gspread")
+_sheet_sem = asyncio.Semaphore(SHEETS_MAX_WORKERS)
+
+async def _sheet_call(fn, *args, **kwargs):
+    async with _sheet_sem:
+        return await asyncio.get_running_loop().run_in_executor(
+            SHEETS_EXECUTOR, functools.partial(fn, *args, **kwargs)
+        )
+
 SHEET = None
 orders_ws = None
 drivers_ws = None
 users_ws = None
 
 def ensure_sheet_structure():
+    """Bind the three worksheets, creating any that are missing (one worksheets() call)."""
     global orders_ws, drivers_ws, users_ws
+    existing = {ws.title: ws for ws in SHEET.worksheets()}
+
+    def get_or_create(title, header, cols):
+        ws = existing.get(title)
+        if ws is not None:
+            logger.debug("Found %s worksheet", title)
+            return ws
+        ws = SHEET.add_worksheet(title=title, rows=4000, cols=cols)
+        ws.append_row(header)
+        logger.debug("Created %s worksheet", title)
+        return ws
+
+    orders_ws = get_or_create(ORDERS_SHEET_NAME, ORDERS_HEADER, 30)
+    drivers_ws = get_or_create(DRIVERS_SHEET_NAME, DRIVERS_HEADER, 30)
+    users_ws = get_or_create(USERS_SHEET_NAME, USERS_HEADER, 10)
+
+# --------------------------- In-memory cache ---------------------------
+# Handlers read from these dicts instead of calling get_all_records() on every
+# update. Each maps the sheet key (as str) to (row_index, record). Writes update
+# the dict first and are queued; sheet_writer() flushes them to Sheets in the
+# background and reloads everything every CACHE_REFRESH_INTERVAL seconds.
+drivers_by_chat = {}
+users_by_id = {}
+orders_by_id = {}
+
+_CACHE_KEYS = {
+    ORDERS_SHEET_NAME: "order_id",
+    DRIVERS_SHEET_NAME: "chat_id",
+    USERS_SHEET_NAME: "user_id",
+}
+_CACHE_HEADERS = {
+    ORDERS_SHEET_NAME: ORDERS_HEADER,
+    DRIVERS_SHEET_NAME: DRIVERS_HEADER,
+    USERS_SHEET_NAME: USERS_HEADER,
+}
+_CACHE_COLUMNS = {
+    ORDERS_SHEET_NAME: "A:O",
+    DRIVERS_SHEET_NAME: "A:N",
+    USERS_SHEET_NAME: "A:D",
+}
+_caches = {
+    ORDERS_SHEET_NAME: orders_by_id,
+    DRIVERS_SHEET_NAME: drivers_by_chat,
+    USERS_SHEET_NAME: users_by_id,
+}
+_next_row = {}          # sheet name -> first free row index
+_dirty_keys = set()     # (sheet name, key) changed locally since the last reload started
+_pending_locations = set()  # driver keys whose latest location is not queued for the sheet yet
+_write_queue = asyncio.Queue()
+_unflushed = []         # writes taken off the queue that have not reached the sheet yet, oldest first
+
+def _worksheet(sheet_name):
+    return {
+        ORDERS_SHEET_NAME: orders_ws,
+        DRIVERS_SHEET_NAME: drivers_ws,
+        USERS_SHEET_NAME: users_ws,
+    }[sheet_name]
+
+def _build_index(values, key_field):
+    """Turn get_all_values() output into {key: (row_index, record)}; first row wins on duplicates."""
+    index = {}
+    if not values:
+        return index
+    header = values[0]
+    for i, row in enumerate(values[1:], start=2):
+        rec = dict(zip(header, row + [""] * (len(header) - len(row))))
+        key = str(rec.get(key_field, "")).strip()
+        if key:
+            index.setdefault(key, (i, rec))
+    return index
+
+def read_all_sheets():
+    """Read the three worksheets in a single spreadsheets.values.batchGet call."""
+    names = list(_CACHE_KEYS)
+    ranges = [f"'{name}'!{_CACHE_COLUMNS[name]}" for name in names]
+    resp = SHEET.values_batch_get(ranges)
+    return {name: vr.get("values", []) for name, vr in zip(names, resp.get("valueRanges", []))}
+
+def load_cache(values_by_sheet: dict):
+    """Replace cached records with fresh sheet values, keeping entries changed locally meanwhile."""
+    for name, key_field in _CACHE_KEYS.items():
+        values = values_by_sheet.get(name) or []
+        index = _build_index(values, key_field)
+        cache = _caches[name]
+        for sheet_name, key in _dirty_keys:
+            if sheet_name == name and key in cache:
+                index[key] = cache[key]
+        cache.clear()
+        cache.update(index)
+        last_row = max((row for row, _ in index.values()), default=1)
+        _next_row[name] = max(len(values), last_row) + 1
+    rebuild_driver_arrays()
+    logger.info("Cache loaded: %d drivers, %d users, %d orders",
+                len(drivers_by_chat), len(users_by_id), len(orders_by_id))
+
+def _queue_append(sheet_name: str, key: str, row: list):
+    """Add a new row to the cache and queue it for writing at the next free row."""
+    if key in _caches[sheet_name]:
+        # replacing it would point the existing record's writes at the new row
+        raise ValueError(f"{sheet_name} already has a row for {key!r}")
+    row_index = _next_row.get(sheet_name, 2)
+    _next_row[sheet_name] = row_index + 1
+    record = dict(zip(_CACHE_HEADERS[sheet_name], row))
+    _caches[sheet_name][key] = (row_index, record)
+    _dirty_keys.add((sheet_name, key))
+    # written to its own A{row} range (not appended) so the row lands where the cache expects
+    _write_queue.put_nowait(("append", sheet_name, f"A{row_index}", [row]))
+    return row_index, record
+
+def _queue_update(sheet_name: str, key: str, a1_range: str, values: list):
+    """Queue a range write for a row whose cached record was already updated."""
+    _dirty_keys.add((sheet_name, key))
+    _write_queue.put_nowait(("update", sheet_name, a1_range, values))
+
+def _queue_pending_locations():
+    """Queue one K:N write per driver that moved since the last location flush."""
+    for key in _pending_locations:
+        entry = drivers_by_chat.get(key)
+        if entry:
+            i, r = entry
+            _queue_update(DRIVERS_SHEET_NAME, key, f"K{i}:N{i}",
+                          [[r["latitude"], r["longitude"], r["last_update"], r["active"]]])
+    _pending_locations.clear()
+
+def _drain_write_queue():
+    """Move queued writes into _unflushed, behind any earlier ones still waiting to be written."""
+    while not _write_queue.empty():
+        _unflushed.append(_write_queue.get_nowait())
+    return list(_unflushed)
+
+def _forget_writes(done):
+    """Drop writes that reached the sheet from _unflushed."""
+    done = {id(w) for w in done}
+    _unflushed[:] = [w for w in _unflushed if id(w) not in done]
+
+async def flush_writes():
+    """Write everything pending in a single values batchUpdate.
+
+    New rows go to the row index the cache gave them rather than through
+    append_rows, whose table detection can drop a row into a blank gap and shift
+    every row below it. Every write targets a fixed range, so a failed flush
+    stays in _unflushed and is simply sent again.
+    """
+    # shielded: cancelling the caller (shutdown) waits for a flush already under
+    # way instead of abandoning it and sending the same rows again
+    flush = asyncio.ensure_future(_flush_unflushed())
     try:
-        orders_ws = SHEET.worksheet(ORDERS_SHEET_NAME)
-        logger.debug("Found Orders worksheet")
-    except Exception:
-        orders_ws = SHEET.add_worksheet(title=ORDERS_SHEET_NAME, rows=4000, cols=30)
-        orders_ws.append_row([
-            "order_id", "client_id", "client_name", "pickup_loc", "pickup_desc",
-            "dest_loc", "dest_desc", "client_price", "currency", "status",
-            "driver_id", "driver_name", "driver_price", "counter_price", "timestamp"
-        ])
-        logger.debug("Created Orders worksheet")
-
+        await asyncio.shield(flush)
+    except asyncio.CancelledError:
+        await asyncio.gather(flush, return_exceptions=True)
+        raise
+
+async def _flush_unflushed():
+    batch = _drain_write_queue()
+    if not batch:
+        return
+    ranges = {}
+    last_row = {}  # sheet name -> highest row a new row is written to
+    for write in batch:
+        op, sheet_name, a1_range, values = write
+        if op == "append":
+            last_row[sheet_name] = max(last_row.get(sheet_name, 0), int(a1_range[1:]))
+        # last write to a range wins and moves to the end to keep ordering
+        ranges.pop((sheet_name, a1_range), None)
+        ranges[(sheet_name, a1_range)] = values
+    for sheet_name, row in last_row.items():
+        ws = _worksheet(sheet_name)
+        if row > ws.row_count:
+            # values batchUpdate cannot write past the grid, so grow it first
+            await _sheet_call(ws.add_rows, row - ws.row_count + SHEET_GROW_ROWS)
+    # all worksheets' ranges in one spreadsheets.values.batchUpdate
+    data = [{"range": f"'{sheet_name}'!{r}", "values": v} for (sheet_name, r), v in ranges.items()]
+    await _sheet_call(SHEET.values_batch_update, body={"valueInputOption": "RAW", "data": data})
+    _forget_writes(batch)
+    logger.debug("Flushed %d queued sheet writes", len(batch))
+
+async def refresh_cache():
+    """Flush pending writes, then reload all sheets into the cache.
+
+    The reload is skipped if the flush fails, so local changes that have not
+    reached the sheet yet are never replaced by its older contents.
+    """
+    _queue_pending_locations()
+    _dirty_keys.clear()
     try:
-        drivers_ws = SHEET.worksheet(DRIVERS_SHEET_NAME)
-        logger.debug("Found Drivers worksheet")
-    except Exception:
-        drivers_ws = SHEET.add_worksheet(title=DRIVERS_SHEET_NAME, rows=4000, cols=30)
-        drivers_ws.append_row([
-            "driver_id", "driver_name", "chat_id", "age", "nationality", "phone",
-            "vehicle_type", "vehicle_make", "vehicle_year", "gender",
-            "latitude", "longitude", "last_update", "active"
-        ])
-        logger.debug("Created Drivers worksheet")
+        await flush_writes()
+    except Exception as e:
+        logger.exception("refresh_cache flush error, keeping the current cache: %s", e)
+        return
+    try:
+        values = await _sheet_call(read_all_sheets)
+    except Exception as e:
+        logger.exception("refresh_cache read error: %s", e)
+        return
+    load_cache(values)
+
+async def sheet_writer():
+    """Background task: flush queued writes and periodically reload the cache."""
+    next_refresh = time.monotonic() + CACHE_REFRESH_INTERVAL
+    next_location_flush = time.monotonic() + LOCATION_WRITE_INTERVAL
+    retry_delay = 0
+    while True:
+        if time.monotonic() >= next_location_flush:
+            _queue_pending_locations()
+            next_location_flush = time.monotonic() + LOCATION_WRITE_INTERVAL
+        if not _unflushed:
+            try:
+                timeout = max(0.1, min(next_refresh, next_location_flush) - time.monotonic())
+                # into _unflushed right away so a shutdown during the delay still writes it
+                _unflushed.append(await asyncio.wait_for(_write_queue.get(), timeout))
+                # let a burst of writes (e.g. several orders at once) land in one flush
+                await asyncio.sleep(SHEET_FLUSH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            await flush_writes()
+        except Exception as e:
+            # keep the writes and retry with backoff (e.g. 429 rate limiting)
+            retry_delay = min(max(2 * retry_delay, SHEET_FLUSH_DELAY), SHEET_RETRY_MAX_DELAY)
+            logger.exception("sheet_writer flush error, retrying in %.1fs: %s", retry_delay, e)
+            await asyncio.sleep(retry_delay)
+            continue
+        retry_delay = 0
+        if time.monotonic() >= next_refresh:
+            await refresh_cache()
+            next_refresh = time.monotonic() + CACHE_REFRESH_INTERVAL
+
+# --------------------------- Driver arrays ---------------------------
+# Structure-of-arrays copy of the driver cache for vectorised search. Slot n of
+# every array belongs to _driver_slots[n]; missing or invalid coordinates are
+# stored as NaN, text filter fields as integer codes from _category_codes.
+_driver_slots = []      # chat_id per slot
+_slot_by_chat = {}      # chat_id -> slot
+_category_codes = {}    # normalised nationality / vehicle_type / gender -> code
+_driver_coord_strs = [] # preformatted "lat,lon" per slot for map links
+_driver_maps_urls = []  # preformatted Google Maps search URL per slot
+MAPS_SEARCH_URL = "https://www.google.com/maps/search/?api=1&query="
+driver_lats = np.empty(0, dtype=np.float64)
+driver_lons = np.empty(0, dtype=np.float64)
+driver_lat_rad = np.empty(0, dtype=np.float64)    # radians(lat), radians(lon) and cos(radians(lat)),
+driver_lon_rad = np.empty(0, dtype=np.float64)    # recomputed only when a driver moves
+driver_cos_lat = np.empty(0, dtype=np.float64)
+driver_nat_codes = np.empty(0, dtype=np.int32)
+driver_vtype_codes = np.empty(0, dtype=np.int32)
+driver_gender_codes = np.empty(0, dtype=np.int32)
+driver_active = np.empty(0, dtype=bool)
+driver_last_epoch = np.empty(0, dtype=np.float64)   # last_update as UTC epoch seconds
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
 
+def _to_epoch(iso_value):
+    # last_update is naive UTC ISO text; unparsable values count as long ago
     try:
-        users_ws = SHEET.worksheet(USERS_SHEET_NAME)
-        logger.debug("Found Users worksheet")
-    except Exception:
-        users_ws = SHEET.add_worksheet(title=USERS_SHEET_NAME, rows=4000, cols=10)
-        users_ws.append_row(["user_id", "name", "role", "timestamp"])
-        logger.debug("Created Users worksheet")
+        return datetime.fromisoformat(str(iso_value)).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return -math.inf
+
+def _is_active(r):
+    return _normalize(r.get("active")) in ("yes", "true")
+
+def _normalize(value):
+    return str(value or "").strip().lower()
+
+def _category_code(value):
+    return _category_codes.setdefault(_normalize(value), len(_category_codes))
+
+def rebuild_driver_arrays():
+    global driver_lats, driver_lons, driver_nat_codes, driver_vtype_codes, driver_gender_codes
+    global driver_active, driver_last_epoch, driver_lat_rad, driver_lon_rad, driver_cos_lat
+    _driver_slots[:] = list(drivers_by_chat)
+    _slot_by_chat.clear()
+    _slot_by_chat.update((key, n) for n, key in enumerate(_driver_slots))
+    recs = [drivers_by_chat[key][1] for key in _driver_slots]
+    _driver_coord_strs[:] = [f"{r.get('latitude')},{r.get('longitude')}" for r in recs]
+    _driver_maps_urls[:] = [MAPS_SEARCH_URL + c for c in _driver_coord_strs]
+    driver_lats = np.array([_to_float(r.get("latitude")) for r in recs], dtype=np.float64)
+    driver_lons = np.array([_to_float(r.get("longitude")) for r in recs], dtype=np.float64)
+    driver_lat_rad = np.radians(driver_lats)
+    driver_lon_rad = np.radians(driver_lons)
+    driver_cos_lat = np.cos(driver_lat_rad)
+    driver_nat_codes = np.array([_category_code(r.get("nationality")) for r in recs], dtype=np.int32)
+    driver_vtype_codes = np.array([_category_code(r.get("vehicle_type")) for r in recs], dtype=np.int32)
+    driver_gender_codes = np.array([_category_code(r.get("gender")) for r in recs], dtype=np.int32)
+    driver_active = np.array([_is_active(r) for r in recs], dtype=bool)
+    driver_last_epoch = np.array([_to_epoch(r.get("last_update")) for r in recs], dtype=np.float64)
+
+def _sync_driver_slot(key: str):
+    """Copy one cached driver into the arrays; a new driver triggers a rebuild."""
+    n = _slot_by_chat.get(key)
+    if n is None:
+        rebuild_driver_arrays()
+        return
+    r = drivers_by_chat[key][1]
+    _driver_coord_strs[n] = f"{r.get('latitude')},{r.get('longitude')}"
+    _driver_maps_urls[n] = MAPS_SEARCH_URL + _driver_coord_strs[n]
+    driver_lats[n] = _to_float(r.get("latitude"))
+    driver_lons[n] = _to_float(r.get("longitude"))
+    driver_lat_rad[n] = math.radians(driver_lats[n])
+    driver_lon_rad[n] = math.radians(driver_lons[n])
+    driver_cos_lat[n] = math.cos(driver_lat_rad[n])
+    driver_nat_codes[n] = _category_code(r.get("nationality"))
+    driver_vtype_codes[n] = _category_code(r.get("vehicle_type"))
+    driver_gender_codes[n] = _category_code(r.get("gender"))
+    driver_active[n] = _is_active(r)
+    driver_last_epoch[n] = _to_epoch(r.get("last_update"))
 
 # --------------------------- Helpers ---------------------------
+@functools.lru_cache(maxsize=1024)
 def format_price(value):
     try:
         v = float(value)
@@ -171,37 +517,72 @@ def format_price(value):
     except Exception:
         return f"{value} {CURRENCY}"
 
+# UTC timestamp for sheet writes, refreshed once a second by tick_now_iso()
+_NOW_ISO = datetime.utcnow().isoformat()
+
+async def tick_now_iso():
+    global _NOW_ISO
+    while True:
+        _NOW_ISO = datetime.utcnow().isoformat()
+        await asyncio.sleep(1)
+
+_id_seq = itertools.count()
+
+def _new_id(prefix: str):
+    # unix seconds plus a per-process sequence, so ids made in the same second differ
+    return f"{prefix}{int(time.time())}{next(_id_seq) % 1000:03d}"
+
 def new_order_id():
-    return f"O{int(time.time())}"
+    return _new_id("O")
 
 def register_user(user_id: int, name: str, role: str):
     try:
-        recs = users_ws.get_all_records()
-        for r in recs:
-            if str(r.get("user_id")) == str(user_id):
-                # Update role if changed
-                if r.get("role") != role:
-                    for i, user_rec in enumerate(recs, start=2):
-                        if str(user_rec.get("user_id")) == str(user_id):
-                            users_ws.update_cell(i, 3, role)
-                            logger.info("Updated user %s role to %s", user_id, role)
-                return
-        users_ws.append_row([user_id, name, role, datetime.utcnow().isoformat()])
+        key = str(user_id)
+        entry = users_by_id.get(key)
+        if entry:
+            i, r = entry
+            # Update role if changed
+            if r.get("role") != role:
+                r["role"] = role
+                _queue_update(USERS_SHEET_NAME, key, f"C{i}", [[role]])
+                logger.info("Updated user %s role to %s", user_id, role)
+            return
+        _queue_append(USERS_SHEET_NAME, key, [user_id, name, role, _NOW_ISO])
         logger.info("Registered user %s as %s", user_id, role)
     except Exception as e:
         logger.exception("register_user error: %s", e)
 
 def get_user_role(user_id: int):
     """Get the role of a user"""
-    try:
-        recs = users_ws.get_all_records()
-        for r in recs:
-            if str(r.get("user_id")) == str(user_id):
-                return r.get("role", "")
-        return ""
-    except Exception as e:
-        logger.exception("get_user_role error: %s", e)
-        return ""
+    entry = users_by_id.get(str(user_id))
+    return entry[1].get("role", "") if entry else ""
+
+def get_driver(chat_id):
+    """Get the cached driver record for chat_id, or None"""
+    entry = drivers_by_chat.get(str(chat_id))
+    return entry[1] if entry else None
+
+def set_pending(application: Application, chat_id, **fields):
+    """Remember what the bot is waiting for from chat_id (e.g. a driver's reply to an order)"""
+    chat_id = int(chat_id)
+    fields["expires_at"] = time.time() + PENDING_TTL
+    # Application.user_data is read-only; the per-user dicts inside it are not
+    application.user_data[chat_id]["pending"] = fields
+    application.mark_data_for_update_persistence(user_ids=chat_id)
+
+def get_pending(application: Application, chat_id):
+    """Get the pending entry for chat_id, or None if there is none or it has expired"""
+    chat_id = int(chat_id)
+    pending = application.user_data.get(chat_id, {}).get("pending")
+    if pending and pending["expires_at"] < time.time():
+        clear_pending(application, chat_id)
+        return None
+    return pending
+
+def clear_pending(application: Application, chat_id):
+    chat_id = int(chat_id)
+    if application.user_data.get(chat_id, {}).pop("pending", None) is not None:
+        application.mark_data_for_update_persistence(user_ids=chat_id)
 
 def register_driver(info: dict):
     """
@@ -209,29 +590,28 @@ def register_driver(info: dict):
       driver_name, chat_id, age, nationality, phone, vehicle_type, vehicle_make, vehicle_year, gender
     """
     try:
-        recs = drivers_ws.get_all_records()
-        for i, r in enumerate(recs, start=2):
-            if str(r.get("chat_id")) == str(info.get("chat_id")):
-                # update fields
-                drivers_ws.update_cell(i, 2, info.get("driver_name", r.get("driver_name", "")))
-                drivers_ws.update_cell(i, 4, info.get("age", r.get("age", "")))
-                drivers_ws.update_cell(i, 5, info.get("nationality", r.get("nationality", "")))
-                drivers_ws.update_cell(i, 6, info.get("phone", r.get("phone", "")))
-                drivers_ws.update_cell(i, 7, info.get("vehicle_type", r.get("vehicle_type", "")))
-                drivers_ws.update_cell(i, 8, info.get("vehicle_make", r.get("vehicle_make", "")))
-                drivers_ws.update_cell(i, 9, info.get("vehicle_year", r.get("vehicle_year", "")))
-                drivers_ws.update_cell(i, 10, info.get("gender", r.get("gender", "")))
-                # ensure active and last_update set if provided
-                drivers_ws.update_cell(i, 14, "yes")
-                drivers_ws.update_cell(i, 13, datetime.utcnow().isoformat())
-                logger.info("Updated driver record chat_id=%s", info.get("chat_id"))
-                return r.get("driver_id")
+        key = str(info.get("chat_id"))
+        entry = drivers_by_chat.get(key)
+        if entry:
+            i, r = entry
+            # update fields; chat_id (column C) is rewritten with its cached value
+            for field in ("driver_name", "age", "nationality", "phone",
+                          "vehicle_type", "vehicle_make", "vehicle_year", "gender"):
+                r[field] = info.get(field, r.get(field, ""))
+            # ensure active and last_update set if provided
+            r["last_update"] = _NOW_ISO
+            r["active"] = "yes"
+            _queue_update(DRIVERS_SHEET_NAME, key, f"B{i}:J{i}", [[r.get(f, "") for f in DRIVERS_HEADER[1:10]]])
+            _queue_update(DRIVERS_SHEET_NAME, key, f"M{i}:N{i}", [[r["last_update"], "yes"]])
+            _sync_driver_slot(key)
+            logger.info("Updated driver record chat_id=%s", info.get("chat_id"))
+            return r.get("driver_id")
         # append new driver
-        driver_id = f"D{int(time.time())}"
-        drivers_ws.append_row([
+        driver_id = _new_id("D")
+        _queue_append(DRIVERS_SHEET_NAME, key, [
             driver_id,
             info.get("driver_name", ""),
-            str(info.get("chat_id", "")),  # Ensure chat_id is string
+            key,  # Ensure chat_id is string
             info.get("age", ""),
             info.get("nationality", ""),
             info.get("phone", ""),
@@ -241,9 +621,10 @@ def register_driver(info: dict):
             info.get("gender", ""),
             info.get("latitude", ""),
             info.get("longitude", ""),
-            datetime.utcnow().isoformat(),
+            _NOW_ISO,
             "yes"
         ])
+        _sync_driver_slot(key)
         logger.info("Added new driver %s for chat_id %s", driver_id, info.get("chat_id"))
         return driver_id
     except Exception as e:
@@ -252,32 +633,38 @@ def register_driver(info: dict):
 
 def update_driver_location(chat_id: int, lat: float, lon: float):
     try:
-        recs = drivers_ws.get_all_records()
-        for i, r in enumerate(recs, start=2):
-            # Compare as strings to avoid type issues
-            if str(r.get("chat_id")) == str(chat_id):
-                drivers_ws.update_cell(i, 11, lat)  # latitude
-                drivers_ws.update_cell(i, 12, lon)  # longitude
-                drivers_ws.update_cell(i, 13, datetime.utcnow().isoformat())  # last_update
-                drivers_ws.update_cell(i, 14, "yes")
-                logger.debug("Updated location for driver %s -> (%s,%s)", chat_id, lat, lon)
-                return True
-        logger.warning("Driver chat_id=%s not found when updating location", chat_id)
-        return False
+        key = str(chat_id)
+        entry = drivers_by_chat.get(key)
+        if not entry:
+            logger.warning("Driver chat_id=%s not found when updating location", chat_id)
+            return False
+        _, r = entry
+        r.update(latitude=lat, longitude=lon, last_update=_NOW_ISO, active="yes")
+        # the cache is updated on every ping; sheet_writer writes the latest
+        # position once per LOCATION_WRITE_INTERVAL
+        _dirty_keys.add((DRIVERS_SHEET_NAME, key))
+        _pending_locations.add(key)
+        _sync_driver_slot(key)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Updated location for driver %s -> (%s,%s)", chat_id, lat, lon)
+        return True
     except Exception as e:
         logger.exception("update_driver_location error: %s", e)
         return False
 
 def set_driver_active(chat_id: int, active: bool):
     try:
-        recs = drivers_ws.get_all_records()
-        for i, r in enumerate(recs, start=2):
-            if str(r.get("chat_id")) == str(chat_id):
-                drivers_ws.update_cell(i, 14, "yes" if active else "no")
-                drivers_ws.update_cell(i, 13, datetime.utcnow().isoformat())
-                logger.debug("Set driver %s active=%s", chat_id, active)
-                return True
-        return False
+        key = str(chat_id)
+        entry = drivers_by_chat.get(key)
+        if not entry:
+            return False
+        i, r = entry
+        r["active"] = "yes" if active else "no"
+        r["last_update"] = _NOW_ISO
+        _queue_update(DRIVERS_SHEET_NAME, key, f"M{i}:N{i}", [[r["last_update"], r["active"]]])
+        _sync_driver_slot(key)
+        logger.debug("Set driver %s active=%s", chat_id, active)
+        return True
     except Exception as e:
         logger.exception("set_driver_active error: %s", e)
         return False
@@ -292,118 +679,143 @@ def add_order_to_sheet(order: dict):
             order.get("status"), order.get("driver_id", ""), order.get("driver_name", ""),
             order.get("driver_price", ""), order.get("counter_price", ""), order.get("timestamp")
         ]
-        orders_ws.append_row(row)
+        _queue_append(ORDERS_SHEET_NAME, str(order.get("order_id")), row)
         logger.info("Order %s appended", order.get("order_id"))
     except Exception as e:
         logger.exception("add_order_to_sheet error: %s", e)
 
+ORDER_UPDATE_FIELDS = ORDERS_HEADER[9:14]  # status, driver_id, driver_name, driver_price, counter_price
+
 def update_order_in_sheet(order_id: str, updates: dict):
     try:
-        recs = orders_ws.get_all_records()
-        for i, r in enumerate(recs, start=2):
-            if str(r.get("order_id")) == str(order_id):
-                if "status" in updates:
-                    orders_ws.update_cell(i, 10, updates.get("status"))
-                if "driver_id" in updates:
-                    orders_ws.update_cell(i, 11, updates.get("driver_id"))
-                if "driver_name" in updates:
-                    orders_ws.update_cell(i, 12, updates.get("driver_name"))
-                if "driver_price" in updates:
-                    orders_ws.update_cell(i, 13, updates.get("driver_price"))
-                if "counter_price" in updates:
-                    orders_ws.update_cell(i, 14, updates.get("counter_price"))
-                logger.debug("Order %s updated with %s", order_id, updates)
-                return True
-        logger.debug("Order %s not found", order_id)
-        return False
+        key = str(order_id)
+        entry = orders_by_id.get(key)
+        if not entry:
+            logger.debug("Order %s not found", order_id)
+            return False
+        i, r = entry
+        for field in ORDER_UPDATE_FIELDS:
+            if field in updates:
+                r[field] = updates.get(field)
+        # status .. counter_price are adjacent, so one range covers any subset
+        _queue_update(ORDERS_SHEET_NAME, key, f"J{i}:N{i}", [[r.get(f, "") for f in ORDER_UPDATE_FIELDS]])
+        logger.debug("Order %s updated with %s", order_id, updates)
+        return True
     except Exception as e:
         logger.exception("update_order_in_sheet error: %s", e)
         return False
 
-def get_active_drivers_records(mark_inactive=True):
+def get_active_driver_slots(mark_inactive=True):
     """
-    Return drivers whose active flag is yes and last_update within INACTIVE_THRESHOLD minutes.
+    Return array slots of drivers whose active flag is yes and last_update within INACTIVE_THRESHOLD minutes.
     If mark_inactive True, set the 'active' column to 'no' for stale drivers.
     """
-    out = []
-    try:
-        recs = drivers_ws.get_all_records()
-        now = datetime.utcnow()
-        for i, r in enumerate(recs, start=2):
-            active_flag = str(r.get("active", "")).lower() in ("yes", "true")
-            last_update = r.get("last_update")
-            if last_update:
-                try:
-                    last_dt = datetime.fromisoformat(last_update)
-                except Exception:
-                    last_dt = now - timedelta(minutes=9999)
-            else:
-                last_dt = now - timedelta(minutes=9999)
-            minutes_diff = (now - last_dt).total_seconds() / 60.0
-            if active_flag and minutes_diff <= INACTIVE_THRESHOLD:
-                out.append(r)
-            elif active_flag and minutes_diff > INACTIVE_THRESHOLD and mark_inactive:
-                # mark as inactive in sheet to keep sheet accurate
-                try:
-                    drivers_ws.update_cell(i, 14, "no")
-                    logger.info("Marked driver chat_id=%s inactive (last_update=%s)", r.get("chat_id"), last_update)
-                except Exception as e:
-                    logger.warning("Could not mark driver inactive: %s", e)
-        logger.debug("Active drivers returned: %d", len(out))
-    except Exception as e:
-        logger.exception("get_active_drivers_records error: %s", e)
-    return out
-
-def haversine(lat1, lon1, lat2, lon2):
-    # returns kilometers
-    try:
-        R = 6371.0
-        phi1 = math.radians(float(lat1))
-        phi2 = math.radians(float(lat2))
-        dphi = math.radians(float(lat2) - float(lat1))
-        dlambda = math.radians(float(lon2) - float(lon1))
-        a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return R * c
-    except Exception:
-        return None
-
-def build_maps_link(client_loc, drivers):
+    fresh = (time.time() - driver_last_epoch) <= INACTIVE_THRESHOLD * 60
+    if mark_inactive:
+        # mark as inactive in sheet to keep sheet accurate
+        stale = []
+        for n in np.flatnonzero(driver_active & ~fresh):
+            key = _driver_slots[n]
+            i, r = drivers_by_chat[key]
+            r["active"] = "no"
+            driver_active[n] = False
+            stale.append((i, key))
+            logger.info("Marked driver chat_id=%s inactive (last_update=%s)", key, r.get("last_update"))
+        # one N{a}:N{b} range per run of adjacent rows
+        stale.sort()
+        start = 0
+        for k in range(1, len(stale) + 1):
+            if k == len(stale) or stale[k][0] != stale[k - 1][0] + 1:
+                run = stale[start:k]
+                _dirty_keys.update((DRIVERS_SHEET_NAME, key) for _, key in run)
+                _queue_update(DRIVERS_SHEET_NAME, run[0][1], f"N{run[0][0]}:N{run[-1][0]}", [["no"]] * len(run))
+                start = k
+    slots = np.flatnonzero(driver_active & fresh)
+    logger.debug("Active drivers returned: %d", len(slots))
+    return slots
+
+def _slot_maps_url(n):
+    return _driver_maps_urls[n] if not math.isnan(driver_lats[n]) else ""
+
+def driver_maps_url(chat_id):
+    """Google Maps link to a cached driver's last position, or "" if unknown"""
+    n = _slot_by_chat.get(str(chat_id).strip())
+    return _slot_maps_url(n) if n is not None else ""
+
+def build_maps_link(client_loc, slots):
     base = "https://www.google.com/maps/dir/"
-    parts = []
+    coords = "/".join(_driver_coord_strs[n] for n in slots)
     if client_loc:
-        parts.append(f"{client_loc[0]},{client_loc[1]}")
-    for d in drivers:
-        lat = d.get("latitude")
-        lon = d.get("longitude")
-        parts.append(f"{lat},{lon}")
-    return base + "/".join(parts)
+        return f"{base}{client_loc[0]},{client_loc[1]}/{coords}"
+    return base + coords
+
+def driver_distances_km(lat, lon, idx):
+    # vectorised haversine from (lat, lon) to the drivers in slots idx,
+    # using the per-driver radians/cos columns of the cache
+    lat_rad = math.radians(lat)
+    lon_rad = math.radians(lon)
+    a = (np.sin((driver_lat_rad[idx] - lat_rad) / 2) ** 2
+         + math.cos(lat_rad) * driver_cos_lat[idx] * np.sin((driver_lon_rad[idx] - lon_rad) / 2) ** 2)
+    return 2 * 6371.0 * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def _nearest(dists, k):
+    """Indices of the k smallest distances, nearest first."""
+    if len(dists) > k:
+        idx = np.argpartition(dists, k - 1)[:k]
+        return idx[np.argsort(dists[idx])]
+    return np.argsort(dists)
 
 def filter_and_sort_drivers(client_loc, nation=None, vtype=None, gender=None):
-    candidates = get_active_drivers_records()
-    filtered = []
-    for d in candidates:
-        try:
-            if nation and str(d.get("nationality", "")).strip().lower() != nation.strip().lower():
-                continue
-            if vtype and str(d.get("vehicle_type", "")).strip().lower() != vtype.strip().lower():
-                continue
-            if gender and str(d.get("gender", "")).strip().lower() != gender.strip().lower():
-                continue
-            lat = d.get("latitude")
-            lon = d.get("longitude")
-            latf = float(lat)
-            lonf = float(lon)
-            dist = None
-            if client_loc:
-                dist = haversine(client_loc[0], client_loc[1], latf, lonf)
-            filtered.append((d, dist))
-        except Exception:
-            continue
+    """(record, distance_km or None, slot) for matching drivers, nearest first"""
+    idx = get_active_driver_slots()
+    mask = ~(np.isnan(driver_lats[idx]) | np.isnan(driver_lons[idx]))
+    for value, codes in ((nation, driver_nat_codes), (vtype, driver_vtype_codes), (gender, driver_gender_codes)):
+        if value:
+            # a value no driver has gets -1 and matches nothing
+            mask &= codes[idx] == _category_codes.get(_normalize(value), -1)
+    idx = idx[mask]
     if client_loc:
-        filtered.sort(key=lambda x: x[1] if x[1] is not None else 99999)
-    logger.debug("filter_and_sort_drivers returned %d candidates", len(filtered))
-    return filtered[:MAX_DISPLAY_DRIVERS]
+        lat, lon = float(client_loc[0]), float(client_loc[1])
+        # cheap bounding box around the client first; haversine only for what is inside
+        dlat_max = SEARCH_RADIUS_KM / 111.0
+        dlon_max = SEARCH_RADIUS_KM / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+        inside = np.flatnonzero(
+            (np.abs(driver_lats[idx] - lat) <= dlat_max) & (np.abs(driver_lons[idx] - lon) <= dlon_max)
+        )
+        idx = idx[inside]
+        dists = driver_distances_km(lat, lon, idx)
+        # the box corners reach past the radius; keep only drivers truly within it
+        near = dists <= SEARCH_RADIUS_KM
+        idx, dists = idx[near], dists[near]
+        result = [(drivers_by_chat[_driver_slots[idx[k]]][1], float(dists[k]), int(idx[k]))
+                  for k in _nearest(dists, MAX_DISPLAY_DRIVERS)]
+    else:
+        result = [(drivers_by_chat[_driver_slots[n]][1], None, int(n)) for n in idx[:MAX_DISPLAY_DRIVERS]]
+    logger.debug("filter_and_sort_drivers returned %d candidates", len(idx))
+    return result
+
+# Driver listing templates, filled from a cached driver record plus n (position) and dist
+DRIVER_CARD_TMPL = (
+    "{n}. 👤 {driver_name} ({nationality}){dist}\n"
+    "🚘 {vehicle_type} {vehicle_make} ({vehicle_year})\n"
+    "🚹 الجنس: {gender}\n"
+    "📞 {phone}\n"
+    "📍 موقع: {maps_url}"
+)
+DRIVER_LINE_TMPL = "{n}. {driver_name}{dist} — {vehicle_type}"
+
+class _CardFields(dict):
+    """format_map mapping that shows a column missing from the sheet as "—" instead of raising KeyError"""
+    def __missing__(self, key):
+        return "—"
+
+def _dist_text(dist):
+    return f" — {dist:.2f} km" if dist is not None else ""
+
+def driver_card(n, d, dist, slot):
+    return DRIVER_CARD_TMPL.format_map(
+        _CardFields(d, n=n, dist=_dist_text(dist), maps_url=_slot_maps_url(slot))
+    )
 
 async def display_nearby_drivers(update: Update, context: ContextTypes.DEFAULT_TYPE, client_loc, client_price="25"):
     """Display nearby drivers to client"""
@@ -413,8 +825,7 @@ async def display_nearby_drivers(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ لم يتم العثور على سائقين قريبين من موقعك حالياً.")
         return
 
-    drivers_only = [d for d, _ in filtered]
-    maps_link = build_maps_link(client_loc, drivers_only)
+    maps_link = build_maps_link(client_loc, [slot for _, _, slot in filtered])
 
     # Ask for price if not provided
     if not client_price:
@@ -423,31 +834,21 @@ async def display_nearby_drivers(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data['client_search_loc'] = client_loc
         return
 
-    # Display drivers with the default or provided price
-    for d, dist in filtered:
+    # Display all drivers in one message with the default or provided price
+    stanzas = []
+    buttons = []
+    for n, (d, dist, slot) in enumerate(filtered, start=1):
         name = d.get("driver_name", "—")
-        nat = d.get("nationality", "—")
-        v = d.get("vehicle_type", "—")
-        vm = d.get("vehicle_make", "")
-        vy = d.get("vehicle_year", "")
-        gen = d.get("gender", "—")
-        phone = d.get("phone", "—")
-        lat = d.get("latitude", "")
-        lon = d.get("longitude", "")
-        dist_text = f" — {dist:.2f} km" if dist is not None else ""
-        text = (
-            f"👤 {name} ({nat}){dist_text}\n"
-            f"🚘 {v} {vm} ({vy})\n"
-            f"🚹 الجنس: {gen}\n"
-            f"📞 {phone}\n"
-            f"📍 موقع: https://www.google.com/maps/search/?api=1&query={lat},{lon}\n"
-            f"💰 السعر المقترح: {format_price(client_price)}"
-        )
-        cbdata = f"request:{d.get('chat_id')}:{client_price}"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🚕 اطلب من هذا السائق", callback_data=cbdata)]])
-        await update.message.reply_text(text, reply_markup=kb)
-
-    await update.message.reply_text(f"🔗 عرض جميع السائقين على الخريطة:\n{maps_link}")
+        stanzas.append(driver_card(n, d, dist, slot))
+        cbdata = f"request:{_driver_slots[slot]}:{client_price}"
+        buttons.append([InlineKeyboardButton(f"🚕 {n}. اطلب {name}", callback_data=cbdata)])
+
+    text = (
+        f"💰 السعر المقترح: {format_price(client_price)}\n\n"
+        + "\n\n".join(stanzas)
+        + f"\n\n🔗 عرض جميع السائقين على الخريطة:\n{maps_link}"
+    )
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons), disable_web_page_preview=True)
 
 # ------------------ States ------------------
 (
@@ -456,6 +857,37 @@ async def display_nearby_drivers(update: Update, context: ContextTypes.DEFAULT_T
     CLIENT_PICK_LOC, CLIENT_NATION, CLIENT_VTYPE, CLIENT_GENDER, CLIENT_PRICE, CLIENT_DISPLAY_CHOICE
 ) = range(14)
 
+# Role keyboard labels; role_choice dispatches on the exact text
+ROLE_CLIENT_LABEL = "🛍️ أنا عميل"
+ROLE_DRIVER_LABEL = "🚗 أنا سائق"
+
+# Client search keyboard: send location or skip it; "لا" skips a filter
+SKIP_LOCATION_LABEL = "تخطي الموقع"
+SKIP_FILTER_WORD = "لا"
+LOCATION_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📍 إرسال موقعي الحالي", request_location=True)], [SKIP_LOCATION_LABEL]],
+    resize_keyboard=True,
+)
+
+# Inline button data is "<action>:<arg>:...", with a fixed number of args per
+# action. The last arg may be the client's free-text price, so it is taken
+# as-is (empty or containing ":")
+CALLBACK_ARG_COUNTS = {
+    "request": 2,                # driver_chat_id, client_price
+    "driver_accept": 3,          # order_id, client_chat_id, client_price
+    "driver_counter": 3,         # order_id, client_chat_id, client_price
+    "driver_reject": 2,          # order_id, client_chat_id
+    "client_accept_counter": 3,  # order_id, driver_chat_id, proposed price
+    "client_reject_counter": 2,  # order_id, driver_chat_id
+}
+
+def parse_callback_data(data):
+    """Split callback data into (action, *args) using the action's arg count; missing args are None"""
+    action, sep, rest = (data or "").partition(":")
+    nargs = CALLBACK_ARG_COUNTS.get(action, 0)
+    args = rest.split(":", nargs - 1) if sep and nargs else []
+    return (action, *args) + (None,) * (nargs - len(args))
+
 # ------------------ Handlers ------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -482,31 +914,41 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     else:
         # New user
-        kb = [["🛍️ أنا عميل", "🚗 أنا سائق"]]
+        kb = [[ROLE_CLIENT_LABEL, ROLE_DRIVER_LABEL]]
         await update.message.reply_text("مرحبًا! اختر نوعك:", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
         logger.debug("User %s ran /start", user_id)
         return ROLE
 
+async def _choose_client_role(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+    register_user(user.id, user.full_name, "client")
+    await update.message.reply_text(
+        "مرحبًا كعميل! 🛍️\n\n"
+        "يمكنك:\n"
+        "• استخدام /find_driver للبحث عن سائقين قريبين\n"
+        "• إرسال موقعك وسيتم عرض السائقين القريبين تلقائياً\n"
+        "• استخدام /become_driver إذا أردت التسجيل كسائق لاحقًا\n"
+        "• استخدام /help للمساعدة"
+    )
+    return ConversationHandler.END
+
+async def _choose_driver_role(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+    register_user(user.id, user.full_name, "driver")
+    context.user_data['driver_temp'] = {}
+    await update.message.reply_text("أدخل عمرك:")
+    return DRIVER_AGE
+
+_ROLE_DISPATCH = {
+    ROLE_CLIENT_LABEL: _choose_client_role,
+    ROLE_DRIVER_LABEL: _choose_driver_role,
+}
+
 async def role_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text or ""
     user = update.effective_user
     logger.debug("role_choice: %s from %s", txt, user.id)
-    if txt == "🛍️ أنا عميل":
-        register_user(user.id, user.full_name, "client")
-        await update.message.reply_text(
-            "مرحبًا كعميل! 🛍️\n\n"
-            "يمكنك:\n"
-            "• استخدام /find_driver للبحث عن سائقين قريبين\n"
-            "• إرسال موقعك وسيتم عرض السائقين القريبين تلقائياً\n"
-            "• استخدام /become_driver إذا أردت التسجيل كسائق لاحقًا\n"
-            "• استخدام /help للمساعدة"
-        )
-        return ConversationHandler.END
-    if txt == "🚗 أنا سائق":
-        register_user(user.id, user.full_name, "driver")
-        context.user_data['driver_temp'] = {}
-        await update.message.reply_text("أدخل عمرك:")
-        return DRIVER_AGE
+    handler = _ROLE_DISPATCH.get(txt)
+    if handler:
+        return await handler(update, context, user)
     await update.message.reply_text("اختر من الأزرار من فضلك.")
     return ROLE
 
@@ -596,8 +1038,9 @@ async def start_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Clear any previous location confirmation
+    # Clear any previous location confirmation and a manual stop
     context.user_data['location_confirmed'] = False
+    context.user_data['tracking_stopped'] = False
     
     # Create keyboard with live location button
     kb = [[KeyboardButton("📍 مشاركة موقعي الحي", request_location=True)]]
@@ -626,6 +1069,8 @@ async def stop_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     ok = set_driver_active(user_id, False)
+    # Telegram keeps sending the live location until it expires; ignore it until /start_tracking
+    context.user_data['tracking_stopped'] = ok
     await update.message.reply_text("تم إيقاف تتبع موقعك — لم تعد تظهر كسائق نشط." if ok else "حدث خطأ أثناء محاولة إيقاف التتبع.")
     logger.info("Driver %s requested stop_tracking", user_id)
 
@@ -633,16 +1078,18 @@ async def stop_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def driver_live_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle live location updates from drivers only"""
     try:
-        # Check if we have a valid message with location
-        if not update.message:
+        # Live Location updates arrive as edits of the original location message
+        message = update.effective_message
+        is_live_update = update.edited_message is not None
+        if not message:
             logger.debug("No message in update")
             return
             
-        if not update.message.location:
-            logger.debug("No location in message - message type: %s", update.message.content_type)
+        if not message.location:
+            logger.debug("No location in message - message type: %s", message.content_type)
             return
         
-        loc = update.message.location
+        loc = message.location
         chat_id = update.effective_user.id
         
         # Additional validation for location coordinates
@@ -650,27 +1097,43 @@ async def driver_live_location(update: Update, context: ContextTypes.DEFAULT_TYP
             logger.debug("Invalid location coordinates: lat=%s, lon=%s", loc.latitude, loc.longitude)
             return
             
-        logger.debug("Received location from user %s: %s,%s", chat_id, loc.latitude, loc.longitude)
+        # runs on every ping from every driver, so skip building the log call when it would be dropped
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received location from user %s: %s,%s", chat_id, loc.latitude, loc.longitude)
         
         # Check user role first
         user_role = get_user_role(chat_id)
         
         if user_role == "driver":
-            # Driver location update
+            if not is_live_update:
+                # a newly shared location starts tracking again, like /start_tracking
+                context.user_data['tracking_stopped'] = False
+                context.user_data['location_confirmed'] = False
+            elif context.user_data.get('tracking_stopped'):
+                return
+            # Driver location update: cache write only, the sheet write is batched per LOCATION_WRITE_INTERVAL
             ok = update_driver_location(chat_id, loc.latitude, loc.longitude)
             if ok:
+                context.user_data['location_error_sent'] = False
                 # Only send confirmation message for the first update to avoid spam
                 if not context.user_data.get('location_confirmed'):
-                    await update.message.reply_text("✅ تم تفعيل التتبع الحي - سيتم تحديث موقعك تلقائياً")
                     context.user_data['location_confirmed'] = True
-                else:
+                    # fire-and-forget so the next queued update isn't held up by this round trip
+                    context.application.create_task(
+                        message.reply_text("✅ تم تفعيل التتبع الحي - سيتم تحديث موقعك تلقائياً"),
+                        update=update,
+                    )
+                elif logger.isEnabledFor(logging.DEBUG):
                     # Silent update for subsequent location updates
                     logger.debug("Silent location update for driver %s", chat_id)
             else:
                 logger.error("Failed to update location for driver %s", chat_id)
-                await update.message.reply_text("⚠️ حدث خطأ أثناء تحديث موقعك.")
-        else:
-            # Client sending live location - automatically show nearby drivers
+                # live updates keep coming every few seconds; tell the driver only once
+                if not context.user_data.get('location_error_sent'):
+                    context.user_data['location_error_sent'] = True
+                    await message.reply_text("⚠️ حدث خطأ أثناء تحديث موقعك.")
+        elif not is_live_update:
+            # Client sending a location (not its live edits) - automatically show nearby drivers
             logger.debug("User %s is client, showing nearby drivers", chat_id)
             client_loc = (loc.latitude, loc.longitude)
             context.user_data['client_search_loc'] = client_loc
@@ -736,40 +1199,38 @@ async def find_driver_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ أنت سائق! يمكنك استخدام /start_tracking لمشاركة موقعك.")
         return ConversationHandler.END
         
-    kb = [[KeyboardButton("📍 إرسال موقعي الحالي", request_location=True)], ["تخطي الموقع"]]
-    await update.message.reply_text("أرسل موقعك الحالي أو اختر 'تخطي الموقع' للبحث بدون موقع.", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+    await update.message.reply_text("أرسل موقعك الحالي أو اختر 'تخطي الموقع' للبحث بدون موقع.", reply_markup=LOCATION_KEYBOARD)
     return CLIENT_PICK_LOC
 
 async def client_pick_loc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text or ""
-    if txt.strip() == "تخطي الموقع":
+    if txt.strip() == SKIP_LOCATION_LABEL:
         context.user_data['client_search_loc'] = None
         await update.message.reply_text("فلترة حسب الجنسية؟ اكتب اسم الجنسية أو 'لا' للتخطي")
         return CLIENT_NATION
     else:
         # If user sends text instead of location, prompt again
-        kb = [[KeyboardButton("📍 إرسال موقعي الحالي", request_location=True)], ["تخطي الموقع"]]
         await update.message.reply_text(
             "الرجاء استخدام الزر أدناه لإرسال موقعك الحالي أو اختر 'تخطي الموقع'",
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=LOCATION_KEYBOARD
         )
         return CLIENT_PICK_LOC
 
 async def client_nation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = (update.message.text or "").strip()
-    context.user_data['filter_nation'] = None if txt == "لا" else txt
+    context.user_data['filter_nation'] = None if txt == SKIP_FILTER_WORD else txt
     await update.message.reply_text("فلترة حسب نوع المركبة؟ اكتب النوع أو 'لا' للتخطي")
     return CLIENT_VTYPE
 
 async def client_vtype(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = (update.message.text or "").strip()
-    context.user_data['filter_vtype'] = None if txt == "لا" else txt
+    context.user_data['filter_vtype'] = None if txt == SKIP_FILTER_WORD else txt
     await update.message.reply_text("فلترة حسب جنس السائق؟ اكتب 'ذكر' أو 'انثى' أو 'لا' للتخطي")
     return CLIENT_GENDER
 
 async def client_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = (update.message.text or "").strip()
-    context.user_data['filter_gender'] = None if txt == "لا" else txt
+    context.user_data['filter_gender'] = None if txt == SKIP_FILTER_WORD else txt
     await update.message.reply_text(f"أدخل السعر المقترح بالـ{CURRENCY} (رقم فقط)، مثال: 25")
     return CLIENT_PRICE
 
@@ -793,50 +1254,36 @@ async def client_display_choice(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ لم يتم العثور على سائقين مطابقين للمعايير.")
         return ConversationHandler.END
 
-    drivers_only = [d for d, _ in filtered]
-    maps_link = build_maps_link(client_loc, drivers_only)
+    maps_link = build_maps_link(client_loc, [slot for _, _, slot in filtered])
 
-    for d, dist in filtered:
+    # One message with a numbered button per driver instead of one message each
+    full = choice == "قائمة نصية"
+    stanzas = []
+    buttons = []
+    for n, (d, dist, slot) in enumerate(filtered, start=1):
         name = d.get("driver_name", "—")
-        nat = d.get("nationality", "—")
-        v = d.get("vehicle_type", "—")
-        vm = d.get("vehicle_make", "")
-        vy = d.get("vehicle_year", "")
-        gen = d.get("gender", "—")
-        phone = d.get("phone", "—")
-        lat = d.get("latitude", "")
-        lon = d.get("longitude", "")
-        dist_text = f" — {dist:.2f} km" if dist is not None else ""
-        text = (
-            f"👤 {name} ({nat}){dist_text}\n"
-            f"🚘 {v} {vm} ({vy})\n"
-            f"🚹 الجنس: {gen}\n"
-            f"📞 {phone}\n"
-            f"📍 موقع: https://www.google.com/maps/search/?api=1&query={lat},{lon}\n"
-            f"💰 سعرك المقترح: {format_price(client_price)}"
-        )
-        cbdata = f"request:{d.get('chat_id')}:{client_price}"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🚕 اطلب من هذا السائق", callback_data=cbdata)]])
-        if choice == "قائمة نصية":
-            await update.message.reply_text(text, reply_markup=kb)
+        if full:
+            stanzas.append(driver_card(n, d, dist, slot))
         else:
-            short = f"{name}{dist_text} — {v} — {format_price(client_price)}"
-            await update.message.reply_text(short, reply_markup=kb)
-
-    await update.message.reply_text(f"🔗 عرض جميع السائقين على الخريطة:\n{maps_link}")
+            stanzas.append(DRIVER_LINE_TMPL.format_map(_CardFields(d, n=n, dist=_dist_text(dist))))
+        cbdata = f"request:{_driver_slots[slot]}:{client_price}"
+        buttons.append([InlineKeyboardButton(f"🚕 {n}. اطلب {name}", callback_data=cbdata)])
+
+    text = (
+        f"💰 سعرك المقترح: {format_price(client_price)}\n\n"
+        + ("\n\n" if full else "\n").join(stanzas)
+        + f"\n\n🔗 عرض جميع السائقين على الخريطة:\n{maps_link}"
+    )
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons), disable_web_page_preview=True)
     return ConversationHandler.END
 
 # Request flow and driver responses (Accept / Counter / Reject)
-async def request_driver_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def request_driver_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, driver_chat_id, client_price):
     query = update.callback_query
     await query.answer()
-    data = query.data or ""
-    parts = data.split(":")
-    if len(parts) < 3:
+    if client_price is None:
         await query.edit_message_text("خطأ في بيانات الطلب.")
         return
-    driver_chat_id = parts[1]
-    client_price = parts[2]
     client = query.from_user
     client_chat_id = client.id
     client_name = client.full_name
@@ -856,32 +1303,19 @@ async def request_driver_callback(update: Update, context: ContextTypes.DEFAULT_
         "driver_name": "",
         "driver_price": "",
         "counter_price": "",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": _NOW_ISO,
     }
     add_order_to_sheet(order)
     await query.edit_message_text("تم إرسال طلبك إلى السائق — ننتظر رده.")
     logger.info("Client %s requested driver %s order %s", client_chat_id, driver_chat_id, order["order_id"])
 
     # send request to driver with inline buttons
-    driver_record = None
-    recs = drivers_ws.get_all_records()
-    for r in recs:
-        if str(r.get("chat_id")) == str(driver_chat_id):
-            driver_record = r
-            break
+    driver_record = get_driver(driver_chat_id)
     if not driver_record:
         await context.bot.send_message(chat_id=client_chat_id, text="لم أستطع إيجاد السائق في السجلات.")
         logger.warning("Driver record not found for chat_id=%s", driver_chat_id)
         return
 
-    # store pending mapping in application.user_data for driver chat
-    context.application.user_data[int(driver_chat_id)] = {
-        "pending_order_id": order["order_id"],
-        "client_chat_id": client_chat_id,
-        "client_name": client_name,
-        "client_price": client_price
-    }
-
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"driver_accept:{order['order_id']}:{client_chat_id}:{client_price}")],
         [InlineKeyboardButton("💬 اقترح سعرًا آخر", callback_data=f"driver_counter:{order['order_id']}:{client_chat_id}:{client_price}")],
@@ -903,16 +1337,13 @@ async def request_driver_callback(update: Update, context: ContextTypes.DEFAULT_
         await context.bot.send_message(chat_id=client_chat_id, text="تعذر إرسال الطلب للسائق (خطأ بالتواصل).")
 
 # Driver accept/reject/counter flows
-async def driver_accept_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def driver_accept_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, client_chat_id, client_price):
     query = update.callback_query
     await query.answer()
-    parts = (query.data or "").split(":")
-    if len(parts) < 4:
+    if client_price is None:
         await query.edit_message_text("بيانات ناقصة.")
         return
-    order_id = parts[1]
-    client_chat_id = int(parts[2])
-    client_price = parts[3]
+    client_chat_id = int(client_chat_id)
     driver_chat_id = query.from_user.id
     driver_name = query.from_user.full_name
 
@@ -926,14 +1357,11 @@ async def driver_accept_callback(update: Update, context: ContextTypes.DEFAULT_T
     logger.info("Driver %s accepted order %s", driver_chat_id, order_id)
 
     # notify client
-    recs = drivers_ws.get_all_records()
-    phone = "—"; vehicle = "—"; lat = lon = None
-    for r in recs:
-        if str(r.get("chat_id")) == str(driver_chat_id):
-            phone = r.get("phone", "—"); vehicle = f"{r.get('vehicle_type','')} {r.get('vehicle_make','')}".strip()
-            lat = r.get("latitude"); lon = r.get("longitude")
-            break
-    maps_link = f"https://www.google.com/maps/search/?api=1&query={lat},{lon}" if lat and lon else ""
+    r = get_driver(driver_chat_id)
+    phone = "—"; vehicle = "—"
+    if r:
+        phone = r.get("phone", "—"); vehicle = f"{r.get('vehicle_type','')} {r.get('vehicle_make','')}".strip()
+    maps_link = driver_maps_url(driver_chat_id)
     try:
         await context.bot.send_message(
             chat_id=client_chat_id,
@@ -948,15 +1376,13 @@ async def driver_accept_callback(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         logger.warning("Could not notify client %s: %s", client_chat_id, e)
 
-async def driver_reject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def driver_reject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, client_chat_id):
     query = update.callback_query
     await query.answer()
-    parts = (query.data or "").split(":")
-    if len(parts) < 3:
+    if client_chat_id is None:
         await query.edit_message_text("بيانات ناقصة.")
         return
-    order_id = parts[1]
-    client_chat_id = int(parts[2])
+    client_chat_id = int(client_chat_id)
     update_order_in_sheet(order_id, {"status": "rejected"})
     await query.edit_message_text("تم رفض الطلب.")
     try:
@@ -965,25 +1391,22 @@ async def driver_reject_callback(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         logger.warning("Could not notify client of rejection: %s", e)
 
-async def driver_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def driver_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, client_chat_id, client_price):
     query = update.callback_query
     await query.answer()
-    parts = (query.data or "").split(":")
-    if len(parts) < 4:
+    if client_price is None:
         await query.edit_message_text("بيانات ناقصة.")
         return
-    order_id = parts[1]
-    client_chat_id = int(parts[2])
-    client_price = parts[3]
+    client_chat_id = int(client_chat_id)
     driver_chat_id = query.from_user.id
-    # store pending counter on application.user_data
-    context.application.user_data[driver_chat_id] = {"pending_counter_order": order_id, "client_chat_id": client_chat_id, "client_price": client_price}
+    # wait for the driver's counter price
+    set_pending(context.application, driver_chat_id, pending_counter_order=order_id, client_chat_id=client_chat_id, client_price=client_price)
     await query.edit_message_text("أدخل السعر الجديد الذي تقترحه (رقم فقط)، ثم أرسله هنا.")
     logger.debug("Driver %s entering counter for order %s", driver_chat_id, order_id)
 
 async def handle_driver_text_for_counter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    data = context.application.user_data.get(user.id)
+    data = get_pending(context.application, user.id)
     if not data or "pending_counter_order" not in data:
         return
     txt = (update.message.text or "").strip()
@@ -1008,18 +1431,15 @@ async def handle_driver_text_for_counter(update: Update, context: ContextTypes.D
         logger.info("Driver %s sent counter %s for order %s", driver_chat_id, proposed, order_id)
     except Exception as e:
         logger.warning("Could not send counter to client %s: %s", client_chat_id, e)
-    context.application.user_data.pop(user.id, None)
+    clear_pending(context.application, user.id)
 
-async def client_accept_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def client_accept_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, driver_chat_id, proposed):
     query = update.callback_query
     await query.answer()
-    parts = (query.data or "").split(":")
-    if len(parts) < 4:
+    if proposed is None:
         await query.edit_message_text("بيانات ناقصة.")
         return
-    order_id = parts[1]
-    driver_chat_id = int(parts[2])
-    proposed = parts[3]
+    driver_chat_id = int(driver_chat_id)
     client_chat_id = query.from_user.id
 
     update_order_in_sheet(order_id, {"status": "accepted", "driver_id": f"D{driver_chat_id}", "driver_price": f"{proposed} {CURRENCY}", "counter_price": f"{proposed} {CURRENCY}"})
@@ -1030,15 +1450,13 @@ async def client_accept_counter_callback(update: Update, context: ContextTypes.D
     except Exception as e:
         logger.warning("Could not notify driver about accepted counter: %s", e)
 
-async def client_reject_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def client_reject_counter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, driver_chat_id):
     query = update.callback_query
     await query.answer()
-    parts = (query.data or "").split(":")
-    if len(parts) < 3:
+    if driver_chat_id is None:
         await query.edit_message_text("بيانات ناقصة.")
         return
-    order_id = parts[1]
-    driver_chat_id = int(parts[2])
+    driver_chat_id = int(driver_chat_id)
     update_order_in_sheet(order_id, {"status": "rejected"})
     await query.edit_message_text("تم رفض عرض السائق. يمكنك اختيار سائق آخر.")
     try:
@@ -1047,6 +1465,25 @@ async def client_reject_counter_callback(update: Update, context: ContextTypes.D
     except Exception as e:
         logger.warning("Could not notify driver about rejected counter: %s", e)
 
+# Inline buttons: one handler parses the callback data and routes on its action
+CALLBACK_HANDLERS = {
+    "request": request_driver_callback,
+    "driver_accept": driver_accept_callback,
+    "driver_reject": driver_reject_callback,
+    "driver_counter": driver_counter_callback,
+    "client_accept_counter": client_accept_counter_callback,
+    "client_reject_counter": client_reject_counter_callback,
+}
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action, *args = parse_callback_data(update.callback_query.data)
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None:
+        await update.callback_query.answer()
+        logger.warning("Unknown callback data: %r", update.callback_query.data)
+        return
+    await handler(update, context, *args)
+
 # Help command
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1096,14 +1533,94 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 # ------------------ MAIN ------------------
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates from different chats concurrently, but one at a time within a chat.
+
+    Keeps each chat's conversation state consistent while a slow Sheets or Bot API
+    call in one chat no longer holds up everyone else.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # the base class's semaphore is taken before do_process_update, i.e. before
+        # the chat lock; keep it out of the way and limit concurrency with our own
+        super().__init__(2**31 - 1)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, number of updates using it]
+
+    async def do_process_update(self, update, coroutine):
+        # take the chat lock before a concurrency slot, so updates queued behind
+        # a slow one in the same chat don't use up the slots
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class UserDataFilter(filters.MessageFilter):
+    """Pass messages whose sender's user_data satisfies check(user_data).
+
+    Lets the catch-all text handlers run only for users the bot is actually
+    waiting on, instead of on every text message.
+    """
+
+    def __init__(self, application: Application, check, name: str):
+        super().__init__(name=name)
+        self._user_data = application.user_data
+        self._check = check
+
+    def filter(self, message):
+        user = message.from_user
+        return bool(user and user.id in self._user_data and self._check(self._user_data[user.id]))
+
+_background_tasks = []
+
+async def post_init(application: Application):
+    # Plain asyncio tasks: Application.stop() waits for create_task() tasks to finish
+    _background_tasks.append(asyncio.create_task(tick_now_iso()))
+    _background_tasks.append(asyncio.create_task(sheet_writer()))
+
+async def post_shutdown(application: Application):
+    for task in _background_tasks:
+        task.cancel()
+    # let a flush that is under way finish before writing what is left
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _queue_pending_locations()
+    try:
+        await flush_writes()
+    except Exception as e:
+        logger.exception("Could not flush %d pending sheet writes on shutdown: %s", len(_unflushed), e)
+    SHEETS_EXECUTOR.shutdown(wait=False)
+
 def main():
-    global SHEET, orders_ws, drivers_ws, users_ws
+    global SHEET
     if BOT_TOKEN.startswith("PUT_YOUR_BOT_TOKEN"):
         logger.error("BOT_TOKEN not set. Please set BOT_TOKEN environment variable or edit the script.")
         return
     if SHEET_ID.startswith("PUT_YOUR_SHEET_ID"):
         logger.error("SHEET_ID not set. Please set SHEET_ID environment variable or edit the script.")
         return
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # without it anyone who finds the URL can post forged updates (e.g. order accepts)
+        logger.error("WEBHOOK_URL is set but WEBHOOK_SECRET is not. Set WEBHOOK_SECRET to use webhook mode.")
+        return
 
     logger.info("Connecting to Google Sheets...")
     try:
@@ -1114,14 +1631,33 @@ def main():
         logger.exception("Failed to connect to Google Sheets: %s", e)
         return
 
-    ensure_sheet_structure()
-    orders_ws = SHEET.worksheet(ORDERS_SHEET_NAME)
-    drivers_ws = SHEET.worksheet(DRIVERS_SHEET_NAME)
-    users_ws = SHEET.worksheet(USERS_SHEET_NAME)
+    try:
+        ensure_sheet_structure()
+        load_cache(read_all_sheets())
+    except Exception as e:
+        logger.exception("Failed to prepare worksheets and cache: %s", e)
+        return
     logger.info("Google Sheets connected and ready.")
 
     # Build application
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .connect_timeout(CONNECT_TIMEOUT)
+        .read_timeout(READ_TIMEOUT)
+        .write_timeout(WRITE_TIMEOUT)
+        .pool_timeout(POOL_TIMEOUT)
+        .persistence(PicklePersistence(
+            PERSISTENCE_PATH,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=PERSISTENCE_FLUSH_INTERVAL,
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add error handler
     app.add_error_handler(error_handler)
@@ -1164,32 +1700,48 @@ def main():
     app.add_handler(MessageHandler(
         filters.LOCATION & 
         filters.ChatType.PRIVATE & 
-        ~filters.UpdateType.EDITED_MESSAGE &
-        ~filters.UpdateType.EDITED_CHANNEL_POST,
+        ~filters.UpdateType.CHANNEL_POSTS,
         driver_live_location
     ))
     
     # Handler for client price input
+    awaiting_price = UserDataFilter(app, lambda ud: ud.get("awaiting_price"), "awaiting_price")
     app.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
+        filters.TEXT & ~filters.COMMAND & awaiting_price,
         handle_client_price_input
     ))
 
-    # callback handlers
-    app.add_handler(CallbackQueryHandler(request_driver_callback, pattern=r"^request:"))
-    app.add_handler(CallbackQueryHandler(driver_accept_callback, pattern=r"^driver_accept:"))
-    app.add_handler(CallbackQueryHandler(driver_reject_callback, pattern=r"^driver_reject:"))
-    app.add_handler(CallbackQueryHandler(driver_counter_callback, pattern=r"^driver_counter:"))
-    app.add_handler(CallbackQueryHandler(client_accept_counter_callback, pattern=r"^client_accept_counter:"))
-    app.add_handler(CallbackQueryHandler(client_reject_counter_callback, pattern=r"^client_reject_counter:"))
+    # callback handler
+    app.add_handler(CallbackQueryHandler(handle_callback))
 
     # driver text handler for counteroffers
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_driver_text_for_counter))
+    awaiting_counter = UserDataFilter(
+        app, lambda ud: "pending_counter_order" in (ud.get("pending") or {}), "awaiting_counter"
+    )
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & awaiting_counter, handle_driver_text_for_counter))
+
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; the webhook server takes PORT, so no Flask health check
+        logger.info("Bot starting webhook on port %d...", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            bootstrap_retries=-1,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        return
 
     logger.info("Bot starting polling...")
     # In your main() function, start this BEFORE app.run_polling()
     threading.Thread(target=run_flask, daemon=True).start()
-    app.run_polling()
+    app.run_polling(
+        timeout=POLL_TIMEOUT,
+        bootstrap_retries=-1,
+        allowed_updates=ALLOWED_UPDATES,
+    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file